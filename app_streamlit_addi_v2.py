@@ -7,6 +7,9 @@ import os
 import unicodedata
 import random
 import re
+import pickle
+import tempfile
+import zlib
 
 import pandas as pd
 import streamlit as st
@@ -233,6 +236,12 @@ def assign_bodega_by_city(row: pd.Series) -> str:
     if any(k in city_val or k in dept_val for k in KEYWORDS_BOGOTA):   return _get_wh_label_for_city("bogota")
     return _get_wh_label_for_city("bogota")
 
+def assign_bodega_batch(df: pd.DataFrame) -> pd.Series:
+    # Bodega por fila calculada una sola vez para todo el DF (mismo índice)
+    if len(df) == 0:
+        return pd.Series([], index=df.index, dtype=object)
+    return df.apply(assign_bodega_by_city, axis=1).astype(object)
+
 # =========================
 # SIDEBAR
 # =========================
@@ -242,6 +251,9 @@ with st.sidebar:
     header_row = st.number_input("Fila de encabezados del template", min_value=1, value=1, step=1)
     start_row = st.number_input("Fila inicial de escritura", min_value=1, value=3, step=1)  # Escribir desde A3
     default_prefix = st.text_input("Prefijo del nombre de salida", value="template_part")
+    split_by_warehouse = st.checkbox("Separar partes por bodega", value=False)
+    spill_to_disk = st.checkbox("Consolidación en disco (orígenes muy grandes)", value=False)
+    spill_partitions = st.number_input("Particiones en disco", min_value=1, value=16, step=1, disabled=not spill_to_disk)
     st.caption("La asignación de **Bodega** se hace por ciudad (mapeo) con fallback por departamento. **La Ciudad se mantiene tal cual del origen**.")
 
 col_u1, col_u2 = st.columns(2)
@@ -475,6 +487,7 @@ def fill_one_chunk(
     template_name: str,
     source_name: str,
     prog: ProgressTracker,
+    bodega_labels: List[str] = None,
 ) -> Tuple[bytes, Dict[str, int]]:
     wb = load_workbook(filename=BytesIO(tmpl_bytes))
     if target_sheet not in wb.sheetnames:
@@ -503,8 +516,8 @@ def fill_one_chunk(
             value = resolve_value(spec, row, template_name, source_name)
             ws.cell(row=row_idx, column=c_idx, value=value)
 
-        # 2) Bodega automática
-        b_label = assign_bodega_by_city(row)
+        # 2) Bodega automática (usa la etiqueta precalculada si viene)
+        b_label = bodega_labels[r_offset] if bodega_labels is not None else assign_bodega_by_city(row)
         if dest_bodega and dest_bodega in header_index:
             c_bod = header_index[dest_bodega]
             ws.cell(row=row_idx, column=c_bod, value=b_label)
@@ -540,18 +553,9 @@ def fill_one_chunk(
 # CONSOLIDACIÓN: 1 registro por (Brand Slug, Nombre de la empresa)
 # Suma Número de tiendas con CAP=4 y fija "Número de orden externo" = brand-empresa
 # =========================
-def consolidate_by_brand_company(df: pd.DataFrame) -> pd.DataFrame:
-    BRAND = "Brand Slug"
-    EMP   = "Nombre de la empresa"
-    QTY   = "Número de tiendas"
-
-    if QTY not in df.columns:
-        st.warning("No se encontró la columna 'Número de tiendas' en el origen. No se consolidará.")
-        return df
-    if BRAND not in df.columns or EMP not in df.columns:
-        st.warning("Faltan columnas para la llave (Brand Slug, Nombre de la empresa). No se consolidará.")
-        return df
+SPILL_READ_ROWS = 50_000  # filas por bloque al particionar en disco
 
+def _consolidate_in_memory(df: pd.DataFrame, BRAND: str, EMP: str, QTY: str) -> Tuple[pd.DataFrame, int, int, int]:
     # Generar/asegurar "Número de orden externo" en TODO el DF (siempre que se pueda)
     df_in = df.copy()
     df_in["Número de orden externo"] = df_in.apply(
@@ -588,7 +592,102 @@ def consolidate_by_brand_company(df: pd.DataFrame) -> pd.DataFrame:
         rows_out.append(rep)
         removed += (len(g) - 1)
 
-    out = pd.DataFrame(rows_out)
+    return pd.DataFrame(rows_out), groups, removed, total_qty
+
+def _consolidate_spill_to_disk(
+    df: pd.DataFrame, BRAND: str, EMP: str, QTY: str, num_partitions: int
+) -> Tuple[pd.DataFrame, int, int, int]:
+    # Fase 1: particionar por hash de la llave normalizada a archivos temporales,
+    # procesando el origen por bloques (sin copiar el DF completo).
+    num_partitions = max(int(num_partitions), 1)
+    out_cols = list(df.columns)
+    if "Número de orden externo" not in out_cols:
+        out_cols.append("Número de orden externo")
+
+    with tempfile.TemporaryDirectory(prefix="addi_consolidacion_") as tmp_dir:
+        part_paths = [Path(tmp_dir) / f"part_{p:04d}.pkl" for p in range(num_partitions)]
+        handles = [open(path, "wb") for path in part_paths]
+        try:
+            for start in range(0, len(df), SPILL_READ_ROWS):
+                block = df.iloc[start:start + SPILL_READ_ROWS].copy()
+                block["__b__"] = block[BRAND].astype(str).map(_norm_hard)
+                block["__e__"] = block[EMP].astype(str).map(_norm_hard)
+                block["__q__"] = pd.to_numeric(block[QTY], errors="coerce").fillna(0).astype(int)
+                block["__p__"] = [
+                    zlib.crc32(f"{b}\x1f{e}".encode("utf-8")) % num_partitions
+                    for b, e in zip(block["__b__"], block["__e__"])
+                ]
+                for p, sub in block.groupby("__p__", sort=False):
+                    pickle.dump(sub.drop(columns="__p__"), handles[int(p)], protocol=pickle.HIGHEST_PROTOCOL)
+                del block
+        finally:
+            for h in handles:
+                h.close()
+
+        # Fase 2: por partición, conservar primera fila y suma de cantidades por llave.
+        # Cada llave cae en una sola partición, así que el tope se aplica sobre el total.
+        rows_out = []
+        groups = 0
+        removed = 0
+        total_qty = 0
+
+        for path in part_paths:
+            firsts: Dict[Tuple[str, str], pd.Series] = {}
+            qty_sums: Dict[Tuple[str, str], int] = {}
+            counts: Dict[Tuple[str, str], int] = {}
+            with open(path, "rb") as fh:
+                while True:
+                    try:
+                        sub = pickle.load(fh)
+                    except EOFError:
+                        break
+                    for key, g in sub.groupby(["__b__", "__e__"], sort=False, dropna=False):
+                        if key not in firsts:
+                            firsts[key] = g.iloc[0]
+                            qty_sums[key] = 0
+                            counts[key] = 0
+                        qty_sums[key] += int(g["__q__"].sum())
+                        counts[key] += len(g)
+                    del sub
+
+            for key, first in firsts.items():
+                groups += 1
+                qty_cap = min(qty_sums[key], 4)  # CAP=4 por llave brand+empresa
+                total_qty += qty_cap
+
+                rep = first.copy()
+                rep[QTY] = qty_cap
+                rep["Número de orden externo"] = make_external_order_slug(rep.get(BRAND, ""), rep.get(EMP, ""))
+                rep["__b__"], rep["__e__"] = key
+                rows_out.append(rep)
+                removed += (counts[key] - 1)
+
+    if not rows_out:
+        return pd.DataFrame(columns=out_cols), groups, removed, total_qty
+
+    # Mismo orden que el groupby en memoria (llaves ordenadas)
+    out = pd.DataFrame(rows_out).sort_values(["__b__", "__e__"], kind="mergesort")
+    out = out[out_cols]
+    return out, groups, removed, total_qty
+
+def consolidate_by_brand_company(
+    df: pd.DataFrame, spill_to_disk: bool = False, num_partitions: int = 16
+) -> pd.DataFrame:
+    BRAND = "Brand Slug"
+    EMP   = "Nombre de la empresa"
+    QTY   = "Número de tiendas"
+
+    if QTY not in df.columns:
+        st.warning("No se encontró la columna 'Número de tiendas' en el origen. No se consolidará.")
+        return df
+    if BRAND not in df.columns or EMP not in df.columns:
+        st.warning("Faltan columnas para la llave (Brand Slug, Nombre de la empresa). No se consolidará.")
+        return df
+
+    if spill_to_disk:
+        out, groups, removed, total_qty = _consolidate_spill_to_disk(df, BRAND, EMP, QTY, num_partitions)
+    else:
+        out, groups, removed, total_qty = _consolidate_in_memory(df, BRAND, EMP, QTY)
 
     # Métricas
     st.session_state._metrics = {
@@ -597,11 +696,43 @@ def consolidate_by_brand_company(df: pd.DataFrame) -> pd.DataFrame:
         "brand_company_removed": removed,
         "cap_per_group": 4,
         "total_qty_after_cap": int(total_qty),
+        "consolidation_spill_partitions": int(num_partitions) if spill_to_disk else 0,
     }
 
-    st.info(f"Consolidación (Brand Slug + Empresa): grupos={groups:,}, filas eliminadas={removed:,}, tope=4 por llave.")
+    modo = f", en disco ({int(num_partitions)} particiones)" if spill_to_disk else ""
+    st.info(f"Consolidación (Brand Slug + Empresa): grupos={groups:,}, filas eliminadas={removed:,}, tope=4 por llave{modo}.")
     return out
 
+# =========================
+# PLAN DE PARTES POR BODEGA
+# Cada parte contiene filas de una sola bodega, en partes balanceadas de máx. chunk_size
+# =========================
+def _balanced_sizes(n: int, chunk_size: int) -> List[int]:
+    if n <= 0:
+        return []
+    parts = (n + chunk_size - 1) // chunk_size
+    base, extra = divmod(n, parts)
+    return [base + 1 if i < extra else base for i in range(parts)]
+
+def plan_parts_by_warehouse(bodegas: pd.Series, chunk_size: int) -> List[Tuple[str, List[int]]]:
+    # Devuelve [(bodega, posiciones)] respetando el orden de WAREHOUSES y el orden original de filas
+    chunk_size = max(int(chunk_size), 1)
+    by_wh: Dict[str, List[int]] = {wh["label"]: [] for wh in WAREHOUSES}
+    for i, label in enumerate(bodegas.tolist()):
+        by_wh.setdefault(label, []).append(i)
+
+    plan: List[Tuple[str, List[int]]] = []
+    for label, positions in by_wh.items():
+        start = 0
+        for size in _balanced_sizes(len(positions), chunk_size):
+            plan.append((label, positions[start:start + size]))
+            start += size
+    return plan
+
+def plan_parts_sequential(total: int, chunk_size: int) -> List[Tuple[str, List[int]]]:
+    chunk_size = max(int(chunk_size), 1)
+    return [("", list(range(start, min(start + chunk_size, total)))) for start in range(0, total, chunk_size)]
+
 # =========================
 # GENERATE
 # =========================
@@ -624,10 +755,19 @@ if do_run:
 
         # >>>> CONSOLIDACIÓN JUSTO ANTES DE ESCRIBIR A EXCEL <<<<
         # 1 registro por (Brand Slug, Nombre de la empresa), sumando y CAP=4; además fija "Número de orden externo".
-        src_df = consolidate_by_brand_company(src_df)
+        src_df = consolidate_by_brand_company(
+            src_df,
+            spill_to_disk=bool(spill_to_disk),
+            num_partitions=int(spill_partitions),
+        )
 
         total = len(src_df)
-        num_parts = (total + chunk_size - 1) // chunk_size
+        bodegas = assign_bodega_batch(src_df)
+        if split_by_warehouse:
+            plan = plan_parts_by_warehouse(bodegas, chunk_size)
+        else:
+            plan = plan_parts_sequential(total, chunk_size)
+        num_parts = len(plan)
         st.info(f"Total filas (tras consolidación): {total}. Tamaño de bloque: {chunk_size}. Partes a generar: {num_parts}.")
 
         template_stem = Path(getattr(tmpl_file, "name", "template.xlsx")).stem
@@ -637,11 +777,12 @@ if do_run:
         agg = {"rows": 0, "nw_written": 0, "no_dest_bodega": 0}
         prog = ProgressTracker(total_rows=total, label="Procesando")
 
+        parts_per_wh: Dict[str, int] = {}
+
         with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for i in range(num_parts):
-                start = i * chunk_size
-                end = min(start + chunk_size, total)
-                chunk = src_df.iloc[start:end].copy()
+            for i, (wh_label, positions) in enumerate(plan):
+                chunk = src_df.iloc[positions].copy()
+                chunk_bodegas = bodegas.iloc[positions].tolist()
 
                 out_xlsx, stats = fill_one_chunk(
                     tmpl_bytes=tmpl_bytes,
@@ -654,12 +795,19 @@ if do_run:
                     template_name=template_stem,
                     source_name=source_stem,
                     prog=prog,
+                    bodega_labels=chunk_bodegas,
                 )
 
                 for k in agg:
                     agg[k] += stats.get(k, 0)
 
-                part_name = f"{default_prefix}{i+1:02d}.xlsx"
+                if split_by_warehouse:
+                    wh_part = parts_per_wh.get(wh_label, 0) + 1
+                    parts_per_wh[wh_label] = wh_part
+                    wh_slug = _slugify_no_spaces(wh_label) or "bodega"
+                    part_name = f"{wh_slug}/{default_prefix}_{wh_slug}_{wh_part:02d}.xlsx"
+                else:
+                    part_name = f"{default_prefix}{i+1:02d}.xlsx"
                 zf.writestr(part_name, out_xlsx)
 
         try:
@@ -681,7 +829,8 @@ if do_run:
         with st.expander("Resumen de procesamiento", expanded=True):
             st.write({
                 **agg,
-                **metrics
+                **metrics,
+                **({"parts_per_warehouse": parts_per_wh} if split_by_warehouse else {}),
             })
     except Exception as e:
         st.error(f"ERROR: {e}")
@@ -694,5 +843,7 @@ with st.expander("📝 Notas", expanded=False):
     - **Correos**: solo `@gmail.com` o `@hotmail.com` (minúscula). Otros → **en blanco**.
     - **Teléfonos vacíos**: se autocompletan con un número colombiano válido (10 dígitos iniciando en 3).
     - **Consolidación final**: se agrupa por **(Brand Slug, Nombre de la empresa)**, se **suman** unidades con **tope 4** por llave y se fija **“Número de orden externo”** como `brand-empresa` (minúscula, sin acentos ni espacios).
+    - **Consolidación en disco** (opcional): para orígenes muy grandes, las filas se reparten por hash de la llave en archivos temporales y se consolidan partición por partición (mismas reglas y tope 4).
     - **Escritura**: inicia en **A3** (configurable) y divide en archivos del tamaño elegido.
+    - **Separar partes por bodega** (opcional): cada archivo contiene filas de una sola bodega, en partes balanceadas (máx. tamaño elegido), dentro de una carpeta por bodega en el ZIP.
     """)